@@ -7,6 +7,11 @@ import os
 import json
 import google.generativeai as genai
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib json module is the fallback
+    orjson = None
+
 def test_gemini_api_simple():
     """
     Test basic Gemini API functionality
@@ -61,9 +66,14 @@ Respond ONLY with valid JSON, no additional text.
                         clean_content = clean_content[:-3]
                     clean_content = clean_content.strip()
                     
-                    parsed_json = json.loads(clean_content)
+                    if orjson:
+                        parsed_json = orjson.loads(clean_content)
+                        pretty_json = orjson.dumps(parsed_json, option=orjson.OPT_INDENT_2).decode()
+                    else:
+                        parsed_json = json.loads(clean_content)
+                        pretty_json = json.dumps(parsed_json, indent=2, ensure_ascii=False)
                     print("✅ JSON generation test successful!")
-                    print(f"📝 JSON response: {json.dumps(parsed_json, indent=2, ensure_ascii=False)}")
+                    print(f"📝 JSON response: {pretty_json}")
                     print()
                     print("🎉 All tests passed! Your API is ready for voice note processing.")
                     return True
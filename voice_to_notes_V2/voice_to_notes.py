@@ -2,18 +2,33 @@ import os
 import sys
 import argparse
 import asyncio
+import aiofiles
 import aiohttp
-import uuid
-from pydub import AudioSegment
+import diskcache
+import hashlib
+import mimetypes
+import mmap
+import random
+import re
+import subprocess
+import textwrap
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
 from datetime import datetime
-import google.generativeai as genai
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 import json
 import time
 
-HF_API_TOKEN = os.getenv("HF_API_TOKEN")
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib json module is the fallback
+    orjson = None
 
-if HF_API_TOKEN is None:
-    raise EnvironmentError("HF_API_TOKEN not found in environment variables.")
+HF_API_TOKEN = os.getenv("HF_API_TOKEN")  # Only required when transcribing through the Hugging Face API
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 WHISPER_MODELS = {
     "tiny": "openai/whisper-tiny",
@@ -23,215 +38,758 @@ WHISPER_MODELS = {
     "large": "openai/whisper-large",
 }
 
-HEADERS = {"Authorization": f"Bearer {HF_API_TOKEN}"}
+HF_MODEL_URLS = {name: f"https://api-inference.huggingface.co/models/{repo}" for name, repo in WHISPER_MODELS.items()}
+
+HF_CONCURRENCY = int(os.getenv("HF_CONCURRENCY", "4"))
+HF_MAX_ATTEMPTS = 6
+HF_RETRY_STATUSES = {429, 502, 503}  # Rate limited, gateway error, model still loading
+
+GEMINI_MODEL = "gemini-1.5-flash"
+GEMINI_CONCURRENCY = 15
+GEMINI_RPM = 15  # Free tier: 15 requests per minute
+GEMINI_MIN_INTERVAL = 1.0  # Seconds between consecutive calls, smooths bursts within the minute
+
+PROMPT_VERSION = 3  # Bump whenever the Gemini prompt changes to invalidate cached summaries
+
+CACHE_DIR = os.path.expanduser("~/.cache/voice_to_notes")
+MODELS_CACHE_PATH = os.path.join(CACHE_DIR, "models.json")
+MODELS_CACHE_TTL = 24 * 60 * 60  # The Gemini model list rarely changes, so it is refreshed once a day
+
+MAP_CHUNK_TOKENS = 2500  # Longer transcriptions are summarized in parts of this size, roughly one HF chunk
+CHARS_PER_TOKEN = 3.5  # Spanish average, used only when count_tokens is unavailable
+
+_STRING_LIST = {"type": "array", "items": {"type": "string"}}
+
+SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "resumen_ejecutivo": {"type": "string"},
+        "puntos_clave": _STRING_LIST,
+        "conceptos_importantes": {**_STRING_LIST, "description": "concepto: explicación"},
+        "preguntas_dudas": _STRING_LIST,
+        "tareas_acciones": _STRING_LIST,
+        "detalles_adicionales": _STRING_LIST,
+        "estructura_contenido": {**_STRING_LIST, "description": "tema: descripción"},
+    },
+    "required": [
+        "resumen_ejecutivo", "puntos_clave", "conceptos_importantes",
+        "preguntas_dudas", "tareas_acciones", "detalles_adicionales",
+        "estructura_contenido",
+    ],
+}
+
+SUMMARY_PROMPT = """
+Eres un asistente especializado en crear resúmenes académicos detallados en español.
+
+Analiza esta transcripción y genera un resumen completo en español.
+
+TRANSCRIPCIÓN:
+{text}
+
+Crea un análisis con:
+1. RESUMEN EJECUTIVO: Un párrafo completo (3-5 oraciones) que capture la esencia de la sesión
+2. PUNTOS CLAVE PRINCIPALES: Lista (3-8 puntos) con explicaciones de cada tema abordado
+3. CONCEPTOS IMPORTANTES: Términos técnicos, teorías, definiciones importantes
+4. PREGUNTAS Y DUDAS: Interrogantes, discusiones y puntos de reflexión mencionados
+5. TAREAS Y ACCIONES: Exámenes, trabajos, fechas, entregas mencionadas
+6. DETALLES ADICIONALES: Ejemplos dados, referencias mencionadas, datos específicos
+7. ESTRUCTURA DEL CONTENIDO: Organización de los temas tratados
+"""
+
+MERGE_PROMPT = """
+Eres un asistente especializado en crear resúmenes académicos detallados en español.
+
+Estos son resúmenes parciales, en orden, de fragmentos consecutivos de una misma transcripción.
+Combínalos en un único resumen completo en español: redacta un resumen ejecutivo que cubra toda
+la sesión, fusiona las listas eliminando duplicados y conserva el orden en que aparecen los temas.
+
+RESÚMENES PARCIALES:
+{summaries}
+"""
+
+SUMMARY_HEADER = """# Resumen de Clase - {stem}
+
+## Metadatos
+- **Fecha:** {date}
+- **Hora:** {time}
+- **Archivo original:** {stem}
+- **Modelo IA:** {model}
+
+## Resumen Ejecutivo
+{resumen_ejecutivo}
+"""
+
+# (heading, summary key, list marker) for each list section
+SUMMARY_SECTIONS = (
+    ("Puntos Clave Principales", "puntos_clave", "-"),
+    ("Conceptos Importantes", "conceptos_importantes", "-"),
+    ("Preguntas y Dudas", "preguntas_dudas", "-"),
+    ("Tareas y Acciones", "tareas_acciones", "- [ ]"),
+    ("Detalles Adicionales", "detalles_adicionales", "-"),
+    ("Estructura del Contenido", "estructura_contenido", "-"),
+)
+
+SINGLE_CHUNK_SECONDS = 10 * 60  # Recordings up to this length are sent as one chunk
+CHUNK_COUNT = 4
+FFMPEG_CONCURRENCY = os.cpu_count() or 4  # ffmpeg processes cutting chunks at once, across every file
+
+# Short recordings in these formats are uploaded to Hugging Face as-is
+HF_PASSTHROUGH_EXTENSIONS = (".mp3", ".m4a", ".flac", ".wav")
+HF_MAX_UPLOAD_BYTES = 24 * 1024 * 1024
+
+AUDIO_EXTENSIONS = (".m4a", ".mp3", ".wav", ".flac", ".aac", ".ogg")
+FILE_CONCURRENCY = int(os.getenv("FILE_CONCURRENCY", "4"))  # Files processed at once with the HF backend
+
+HEADERS = {
+    "Authorization": f"Bearer {HF_API_TOKEN}",
+    # Block until a cold model is loaded instead of answering 503, and let HF reuse results for identical audio
+    "x-wait-for-model": "true",
+    "x-use-cache": "true",
+}
+
+_SESSION = None  # Shared aiohttp session, created on first use by _get_session
+
+_SENT_RE = re.compile(r"[^.\n]+")
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+HF_SEMAPHORE = asyncio.Semaphore(HF_CONCURRENCY)
+FFMPEG_SEMAPHORE = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+GEMINI_SEMAPHORE = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def parse_summary_json(content):
+    try:
+        return json_loads(content)
+    except ValueError:
+        # JSON mode should make this unnecessary, but tolerate prose or fences around the object
+        match = _JSON_OBJECT_RE.search(content)
+        if match is None:
+            raise
+        return json_loads(match.group(0))
+
+
+def json_dumps_pretty(obj):
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
+
+# The disk caches are opened on first use so that --help never creates anything under CACHE_DIR
+@lru_cache(maxsize=None)
+def _gemini_cache():
+    return diskcache.Cache(os.path.join(CACHE_DIR, "gemini"))
+
+
+@lru_cache(maxsize=None)
+def _hf_cache():
+    return diskcache.Cache(os.path.join(CACHE_DIR, "huggingface"))
+
+
+@dataclass
+class TranscriptionBundle:
+    """Transcription text plus its paragraphs, split once and shared by every consumer."""
+
+    text: str
+    paragraphs: list[str]
+
+    @classmethod
+    def from_paragraphs(cls, paragraphs, separator="\n\n"):
+        paragraphs = [paragraph for raw in paragraphs if (paragraph := raw.strip())]
+        return cls(separator.join(paragraphs), paragraphs)
+
+
+class GeminiRateLimiter:
+    """Sliding-window limiter: waits only when the last minute's quota is used up
+    or the previous call was less than min_interval ago."""
+
+    def __init__(self, max_calls=GEMINI_RPM, period=60.0, min_interval=GEMINI_MIN_INTERVAL):
+        self.max_calls = max_calls
+        self.period = period
+        self.min_interval = min_interval
+        self._calls = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            while self._calls and now - self._calls[0] >= self.period:
+                self._calls.popleft()
+
+            if len(self._calls) >= self.max_calls:
+                await asyncio.sleep(self._calls[0] + self.period - now)
+                self._calls.popleft()
+
+            if self._calls:
+                wait = self._calls[-1] + self.min_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+            self._calls.append(time.monotonic())
+
+
+GEMINI_RATE_LIMITER = GeminiRateLimiter()
+
+
+async def _run_command(*command):
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+    return stdout
+
+
+async def probe_audio(audio_path):
+    output = await _run_command(
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "format=duration:stream=codec_name", "-of", "json", audio_path,
+    )
+    info = json_loads(output)
+    return float(info["format"]["duration"]), info["streams"][0]["codec_name"]
+
+
+async def fragment_audio(audio_path):
+    duration, codec = await probe_audio(audio_path)
 
+    if duration <= SINGLE_CHUNK_SECONDS:
+        if (audio_path.lower().endswith(HF_PASSTHROUGH_EXTENSIONS)
+                and os.path.getsize(audio_path) < HF_MAX_UPLOAD_BYTES):
+            return [audio_path]
+        chunk_count = 1
+    else:
+        chunk_count = CHUNK_COUNT
 
-def fragment_audio(audio_path, chunk_dir):
-    os.makedirs(chunk_dir, exist_ok=True)
-    audio = AudioSegment.from_file(audio_path)
-    duration_ms = len(audio)
+    # MP3 streams are cut in the compressed domain; anything else is encoded to MP3 once
+    codec_args = ["-c", "copy"] if codec == "mp3" else ["-c:a", "libmp3lame"]
+    chunk_seconds = duration / chunk_count
 
-    if duration_ms <= 10 * 60 * 1000:
-        output_path = os.path.join(chunk_dir, "chunk_0.mp3")
-        audio.export(output_path, format="mp3")
-        return [output_path]
+    commands = []
+    for i in range(chunk_count):
+        command = ["ffmpeg", "-v", "error", "-ss", str(i * chunk_seconds)]
+        if i < chunk_count - 1:
+            command += ["-t", str(chunk_seconds)]
+        command += ["-i", audio_path, "-map", "0:a:0", *codec_args, "-f", "mp3", "pipe:1"]
+        commands.append(command)
 
-    chunk_len = duration_ms // 4
-    chunk_paths = []
+    async def cut_chunk(command):
+        async with FFMPEG_SEMAPHORE:
+            return await _run_command(*command)
 
-    for i in range(4):
-        start = i * chunk_len
-        end = (i + 1) * chunk_len if i < 3 else duration_ms
-        chunk = audio[start:end]
-        path = os.path.join(chunk_dir, f"chunk_{i}.mp3")
-        chunk.export(path, format="mp3")
-        chunk_paths.append(path)
+    # One ffmpeg process per chunk, bounded across the batch; chunks stay in memory and never touch disk
+    return await asyncio.gather(*[cut_chunk(command) for command in commands])
 
-    return chunk_paths
 
+async def _stream_file(file_path, block_size=64 * 1024):
+    async with aiofiles.open(file_path, "rb") as f:
+        while block := await f.read(block_size):
+            yield block
 
-async def transcribe_chunk(session, file_path, model_url):
+
+def _retry_delay(resp, error, attempt):
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return float(retry_after)
+
+    try:
+        estimated_time = json_loads(error).get("estimated_time")
+    except (ValueError, AttributeError):
+        estimated_time = None
+    if estimated_time:
+        return float(estimated_time)
+
+    return min(2 ** attempt, 30) + random.uniform(0, 1)
+
+
+@lru_cache(maxsize=256)
+def _cached_file_sha256(file_path, size, mtime_ns):
     with open(file_path, "rb") as f:
-        audio_data = f.read()
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        # Python < 3.11: hash through mmap so the file is never copied into a bytes object
+        if size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+
+def _file_sha256(file_path):
+    # Size and mtime are part of the key so a rewritten file is hashed again
+    stat = os.stat(file_path)
+    return _cached_file_sha256(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+def _chunk_sha256(chunk):
+    if isinstance(chunk, bytes):
+        return hashlib.sha256(chunk).hexdigest()
+    return _file_sha256(chunk)
+
+
+async def transcribe_chunk(session, chunk, model_url, name):
+    """Transcribe one chunk, given either as in-memory MP3 bytes or as the path of a passthrough file."""
+    digest = await asyncio.to_thread(_chunk_sha256, chunk)
+    cache_key = f"{model_url}|{digest}"
+    cached_text = _hf_cache().get(cache_key)
+    if cached_text is not None:
+        print(f"Using cached transcription for {name}")
+        return cached_text
+
+    if isinstance(chunk, bytes):
+        content_type = "audio/mpeg"
+    else:
+        content_type = mimetypes.guess_type(chunk)[0] or "application/octet-stream"
+    headers = {**HEADERS, "Content-Type": content_type}
+
+    for attempt in range(HF_MAX_ATTEMPTS):
+        data = chunk if isinstance(chunk, bytes) else _stream_file(chunk)
+        async with HF_SEMAPHORE, session.post(model_url, headers=headers, data=data) as resp:
+            if resp.status == 200:
+                json_data = await resp.json()
+                text = json_data.get("text", "")
+                _hf_cache().set(cache_key, text)
+                return text
 
-    async with session.post(model_url, headers=HEADERS, data=audio_data) as resp:
-        if resp.status == 200:
-            json_data = await resp.json()
-            return json_data.get("text", "")
-        else:
             error = await resp.text()
-            return f"[ERROR] {resp.status}: {error}"
+            if resp.status not in HF_RETRY_STATUSES or attempt == HF_MAX_ATTEMPTS - 1:
+                raise RuntimeError(f"Hugging Face API error {resp.status} for {name}: {error}")
+            delay = _retry_delay(resp, error, attempt)
 
+        print(f"Hugging Face returned {resp.status} for {name}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
 
-async def transcribe_all_chunks(chunk_paths, model):
-    model_url = f"https://api-inference.huggingface.co/models/{WHISPER_MODELS[model]}"
-    async with aiohttp.ClientSession() as session:
-        tasks = [transcribe_chunk(session, path, model_url) for path in chunk_paths]
-        return await asyncio.gather(*tasks)
 
+async def _get_session():
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, limit_per_host=16, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=600, sock_connect=10),
+        )
+    return _SESSION
 
-def save_transcription(text, output_dir, base_name):
-    os.makedirs(output_dir, exist_ok=True)
-    path = os.path.join(output_dir, f"{base_name}.txt")
-    with open(path, "w") as f:
-        f.write(text)
-    print(f"Transcription saved to: {path}")
-    return path
 
+async def _close_session():
+    global _SESSION
+    if _SESSION is not None:
+        await _SESSION.close()
+        _SESSION = None
 
-def create_obsidian_summary_only(gemini_summary, original_filename, output_path, gemini_model="gemini-1.5-flash"):
-    current_date = datetime.now().strftime("%Y-%m-%d")
-    current_time = datetime.now().strftime("%H:%M")
 
-    markdown_content = f"""# Resumen de Clase - {original_filename}
+async def _indexed(index, coro):
+    return index, await coro
 
-## Metadatos
-- **Fecha:** {current_date}
-- **Hora:** {current_time}
-- **Archivo original:** {original_filename}
-- **Modelo IA:** {gemini_model}
 
-## Resumen Ejecutivo
-{gemini_summary.get('resumen_ejecutivo', 'No disponible')}
+async def transcribe_all_chunks(chunks, model, audio_path):
+    """Yield (index, text) for each chunk as it is transcribed.
 
-## Puntos Clave Principales
-"""
-    for punto in gemini_summary.get("puntos_clave", []):
-        markdown_content += f"- {punto}\n"
+    Takes ownership of `chunks`: the caller should drop its own reference so each
+    chunk's bytes can be freed as soon as its upload finishes.
+    """
+    model_url = HF_MODEL_URLS[model]
+    session = await _get_session()
+    chunk_count = len(chunks)
+    tasks = [
+        asyncio.create_task(
+            _indexed(i, transcribe_chunk(session, chunk, model_url, f"{audio_path} [chunk {i + 1}/{chunk_count}]"))
+        )
+        for i, chunk in enumerate(chunks)
+    ]
+    del chunks  # From here on only the upload tasks reference the chunk bytes
 
-    markdown_content += "\n## Conceptos Importantes\n"
-    for concepto in gemini_summary.get("conceptos_importantes", []):
-        markdown_content += f"- {concepto}\n"
+    # Yield (index, text) in completion order; callers restore the original order themselves
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # A failed chunk fails the whole file, so stop the sibling uploads instead of letting them burn quota
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def transcribe_remote(audio_path, model, txt_path, on_chunk=None):
+    chunks = await fragment_audio(audio_path)
+    chunk_count = len(chunks)
+
+    print(f"Audio split into {chunk_count} chunk(s)")
+    print(f"Sending chunks to Hugging Face API using model: {model}")
+
+    # Out-of-order chunks wait in `buffered` until every earlier chunk has been written to the .txt
+    paragraphs = []
+    buffered = {}
+    next_index = 0
+    results = transcribe_all_chunks(chunks, model, audio_path)
+    del chunks  # Handed over to transcribe_all_chunks
+    try:
+        async with aiofiles.open(txt_path, "w", encoding="utf-8") as txt_file:
+            async for index, text in results:
+                if on_chunk is not None:
+                    on_chunk(index, text, chunk_count)
+                buffered[index] = text
+                while next_index in buffered:
+                    paragraph = buffered.pop(next_index).strip()
+                    if paragraph:
+                        await txt_file.write(("\n\n" if paragraphs else "") + paragraph)
+                        paragraphs.append(paragraph)
+                    next_index += 1
+                await txt_file.flush()
+    finally:
+        # Close the generator right away so its pending uploads are cancelled even if this side raised
+        await results.aclose()
+
+    print(f"Transcription saved to: {txt_path}")
+    return TranscriptionBundle.from_paragraphs(paragraphs)
+
+
+@lru_cache(maxsize=None)
+def get_local_whisper_model(model):
+    from faster_whisper import WhisperModel
+
+    # "auto" picks CUDA when available; CTranslate2 falls back to the closest supported compute type
+    return WhisperModel(model, device="auto", compute_type="int8")
+
+
+def transcribe_local(audio_path, model, txt_path):
+    whisper_model = get_local_whisper_model(model)
+    segments, _ = whisper_model.transcribe(audio_path, beam_size=1, vad_filter=True)
+
+    # faster-whisper decodes lazily, so each segment reaches the .txt as soon as it is transcribed
+    paragraphs = []
+    with open(txt_path, "w", encoding="utf-8") as txt_file:
+        for segment in segments:
+            paragraph = segment.text.strip()
+            if paragraph:
+                txt_file.write(("\n" if paragraphs else "") + paragraph)
+                txt_file.flush()
+                paragraphs.append(paragraph)
+
+    print(f"Transcription saved to: {txt_path}")
+    return TranscriptionBundle.from_paragraphs(paragraphs, separator="\n")
+
+
+def _build_meta(audio_path, gemini_model=GEMINI_MODEL):
+    now = datetime.now()
+    return {
+        "date": now.strftime("%Y-%m-%d"),
+        "time": now.strftime("%H:%M"),
+        "stem": Path(audio_path).stem,
+        "model": gemini_model,
+    }
 
-    markdown_content += "\n## Preguntas y Dudas\n"
-    for pregunta in gemini_summary.get("preguntas_dudas", []):
-        markdown_content += f"- {pregunta}\n"
 
-    markdown_content += "\n## Tareas y Acciones\n"
-    for tarea in gemini_summary.get("tareas_acciones", []):
-        markdown_content += f"- [ ] {tarea}\n"
+def _bullets(items, marker="-"):
+    return "\n".join(f"{marker} {item}" for item in items) or "- (ninguno)"
 
-    markdown_content += "\n## Detalles Adicionales\n"
-    for detalle in gemini_summary.get("detalles_adicionales", []):
-        markdown_content += f"- {detalle}\n"
 
-    markdown_content += "\n## Estructura del Contenido\n"
-    for estructura in gemini_summary.get("estructura_contenido", []):
-        markdown_content += f"- {estructura}\n"
+def render_obsidian_summary(gemini_summary, meta):
+    parts = [SUMMARY_HEADER.format(
+        **meta,
+        resumen_ejecutivo=gemini_summary.get('resumen_ejecutivo', 'No disponible'),
+    )]
+    for heading, key, marker in SUMMARY_SECTIONS:
+        parts.append(f"\n## {heading}\n{_bullets(gemini_summary.get(key, []), marker)}\n")
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(markdown_content)
-    print(f"Summary saved to: {output_path}")
+    return "".join(parts)
 
-def get_available_gemini_models():
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    models = genai.list_models()
-    return [model.name for model in models]
 
-def generate_gemini_summary(text, model="gemini-1.5-flash"):
-    api_key = os.getenv('GEMINI_API_KEY')
-    if not api_key:
-        print("❌ GEMINI_API_KEY not found")
-        return None
+@lru_cache(maxsize=None)
+def _genai():
+    # google.generativeai pulls in grpc and google.auth, so it is only imported once Gemini is needed
+    import google.generativeai as genai
 
-    genai.configure(api_key=api_key)
+    if GEMINI_API_KEY:
+        genai.configure(api_key=GEMINI_API_KEY)
+    return genai
 
-    prompt = f"""
-Eres un asistente especializado en crear resúmenes académicos detallados en español.
 
-Analiza esta transcripción y genera un resumen completo en español.
+@lru_cache(maxsize=8)
+def get_gemini_model(name=GEMINI_MODEL):
+    return _genai().GenerativeModel(name)
 
-TRANSCRIPCIÓN:
-{text}
 
-Crea un análisis con:
-1. RESUMEN EJECUTIVO: Un párrafo completo (3-5 oraciones) que capture la esencia de la sesión
-2. PUNTOS CLAVE PRINCIPALES: Lista (3-8 puntos) con explicaciones de cada tema abordado
-3. CONCEPTOS IMPORTANTES: Términos técnicos, teorías, definiciones importantes
-4. PREGUNTAS Y DUDAS: Interrogantes, discusiones y puntos de reflexión mencionados
-5. TAREAS Y ACCIONES: Exámenes, trabajos, fechas, entregas mencionadas
-6. DETALLES ADICIONALES: Ejemplos dados, referencias mencionadas, datos específicos
-7. ESTRUCTURA DEL CONTENIDO: Organización de los temas tratados
+@lru_cache(maxsize=1)
+def get_available_gemini_models():
+    try:
+        if time.time() - os.path.getmtime(MODELS_CACHE_PATH) < MODELS_CACHE_TTL:
+            with open(MODELS_CACHE_PATH, "rb") as f:
+                return tuple(json_loads(f.read()))
+    except (OSError, ValueError):
+        pass
+
+    names = [model.name for model in _genai().list_models()]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(MODELS_CACHE_PATH, "w", encoding="utf-8") as f:
+        json.dump(names, f)
+    return tuple(names)
 
-IMPORTANTE: Responde ÚNICAMENTE con un JSON válido usando estas claves exactas:
-{{
-    "resumen_ejecutivo": "string con párrafo detallado",
-    "puntos_clave": ["explicación del punto 1", "explicación del punto 2"],
-    "conceptos_importantes": ["concepto: explicación", "concepto: explicación"],
-    "preguntas_dudas": ["pregunta con contexto", "pregunta con contexto"],
-    "tareas_acciones": ["tarea específica", "acción específica"],
-    "detalles_adicionales": ["ejemplo relevante", "dato específico"],
-    "estructura_contenido": ["tema 1: descripción", "tema 2: descripción"]
-}}
-
-Solo JSON, sin texto adicional.
-"""
 
+async def check_gemini_access(model=GEMINI_MODEL):
+    if not GEMINI_API_KEY:
+        print("❌ GEMINI_API_KEY not found")
+        return False
+
+    try:
+        await asyncio.to_thread(_genai().get_model, f"models/{model}")
+        return True
+    except Exception as e:
+        print(f"Error accediendo a Gemini: {e}")
+        return False
+
+
+def _is_resource_exhausted(error):
+    from google.api_core.exceptions import ResourceExhausted
+
+    return isinstance(error, ResourceExhausted)
+
+
+@retry(
+    retry=retry_if_exception(_is_resource_exhausted),
+    wait=wait_exponential(multiplier=2, max=60),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+async def generate_gemini_content(gemini_model, prompt, generation_config):
+    await GEMINI_RATE_LIMITER.acquire()
+    async with GEMINI_SEMAPHORE:
+        response = await gemini_model.generate_content_async(prompt, generation_config=generation_config)
+        return response.text
+
+
+async def request_gemini_summary(prompt, gemini_model, generation_config):
+    cache_key = hashlib.sha256(f"{gemini_model.model_name}|{PROMPT_VERSION}|{prompt}".encode()).hexdigest()
+    cached_summary = _gemini_cache().get(cache_key)
+    if cached_summary is not None:
+        print("Using cached Gemini summary")
+        return cached_summary
+
+    content = await generate_gemini_content(gemini_model, prompt, generation_config)
+    summary_json = parse_summary_json(content)
+
+    _gemini_cache().set(cache_key, summary_json)
+    return summary_json
+
+
+def _pack_paragraphs(paragraphs, max_chars):
+    parts, current, size = [], [], 0
+    for paragraph in paragraphs:
+        pieces = [paragraph]
+        if len(paragraph) > max_chars:
+            pieces = textwrap.wrap(paragraph, max_chars, replace_whitespace=False, break_long_words=False)
+        for piece in pieces:
+            if current and size + len(piece) > max_chars:
+                parts.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece)
+    if current:
+        parts.append("\n\n".join(current))
+    return parts
+
+
+async def count_gemini_tokens(text, gemini_model):
+    cache_key = hashlib.sha256(f"tokens|{gemini_model.model_name}|{text}".encode()).hexdigest()
+    token_count = _gemini_cache().get(cache_key)
+    if token_count is None:
+        try:
+            token_count = (await gemini_model.count_tokens_async(text)).total_tokens
+        except Exception as e:
+            print(f"Error contando tokens, usando una estimación: {e}")
+            return int(len(text) / CHARS_PER_TOKEN)
+        _gemini_cache().set(cache_key, token_count)
+    return token_count
+
+
+@lru_cache(maxsize=None)
+def _summary_generation_config():
     model_config = {
         "max_tokens": 4096,
         "temperature": 0.7,
     }
 
-    generation_config = genai.types.GenerationConfig(
+    return _genai().types.GenerationConfig(
         max_output_tokens=model_config["max_tokens"],
         temperature=model_config["temperature"],
+        response_mime_type="application/json",
+        response_schema=SUMMARY_SCHEMA,
     )
 
-    gemini_model = genai.GenerativeModel(model)
 
-    time.sleep(2)  # Evitar rate limits
+async def summarize_part(text, gemini_model):
+    prompt = SUMMARY_PROMPT.format(text=text)
+    return await request_gemini_summary(prompt, gemini_model, _summary_generation_config())
+
 
+async def merge_summaries(partial_summaries, gemini_model):
+    prompt = MERGE_PROMPT.format(summaries=json_dumps_pretty(partial_summaries))
+    return await request_gemini_summary(prompt, gemini_model, _summary_generation_config())
+
+
+async def _gather_or_cancel(*aws):
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
     try:
-        response = gemini_model.generate_content(prompt, generation_config=generation_config)
-        content = response.text.strip()
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # gather leaves the other awaitables running on failure; nobody would await them anymore
+        for task in tasks:
+            task.cancel()
+        raise
 
-        if content.startswith('```json'):
-            content = content[7:]
-        elif content.startswith('```'):
-            content = content[3:]
-        if content.endswith('```'):
-            content = content[:-3]
 
-        summary_json = json.loads(content)
+async def map_summaries(paragraphs, text, gemini_model):
+    token_count = await count_gemini_tokens(text, gemini_model)
+    if token_count <= MAP_CHUNK_TOKENS:
+        return [await summarize_part(text, gemini_model)]
 
-        required_keys = [
-            "resumen_ejecutivo", "puntos_clave", "conceptos_importantes",
-            "preguntas_dudas", "tareas_acciones", "detalles_adicionales", 
-            "estructura_contenido"
-        ]
-        for key in required_keys:
-            if key not in summary_json:
-                summary_json[key] = []
+    # Map: summarize each part of at most MAP_CHUNK_TOKENS concurrently
+    max_chars = int(len(text) * MAP_CHUNK_TOKENS / token_count)
+    parts = _pack_paragraphs(paragraphs, max_chars)
+    print(f"Transcription split into {len(parts)} parts for Gemini")
+    return await _gather_or_cancel(*[summarize_part(part, gemini_model) for part in parts])
 
-        return summary_json
+
+async def generate_gemini_summary(transcription, gemini_model, partial_tasks=None):
+    try:
+        if partial_tasks:
+            # Map summaries already started while the audio was being transcribed, one list per chunk
+            chunk_summaries = await _gather_or_cancel(*partial_tasks)
+            partial_summaries = [summary for summaries in chunk_summaries for summary in summaries]
+        else:
+            partial_summaries = await map_summaries(transcription.paragraphs, transcription.text, gemini_model)
+
+        if len(partial_summaries) == 1:
+            return partial_summaries[0]
+
+        # Reduce: merge the partial summaries
+        return await merge_summaries(partial_summaries, gemini_model)
 
     except Exception as e:
         print(f"Error llamando a Gemini: {e}")
         return None
 
 
+def generate_basic_summary(text, max_points=5):
+    sentences = [sentence for match in _SENT_RE.finditer(text) if (sentence := match.group().strip())]
+    return {
+        "resumen_ejecutivo": ". ".join(sentences[:3]) + "." if sentences else "No disponible",
+        "puntos_clave": sentences[3:3 + max_points],
+    }
+
+
+async def aprocess_voice_note_gemini(audio_path, model, output_dir, gemini_access, gemini_model, local=False):
+    meta = _build_meta(audio_path)
+    base_name = meta["stem"]
+    txt_path = os.path.join(output_dir, f"{base_name}.txt")
+
+    map_tasks = {}
+
+    async def summarize_chunk(text):
+        if await gemini_access:
+            return await map_summaries([text], text, gemini_model)
+
+    def on_chunk(index, text, chunk_count):
+        # Multi-chunk recordings are map-reduced per chunk, starting while later chunks transcribe
+        if chunk_count > 1 and text.strip():
+            map_tasks[index] = asyncio.ensure_future(summarize_chunk(text))
+
+    if local:
+        print(f"Transcribing locally with faster-whisper model: {model}")
+        transcription = asyncio.to_thread(transcribe_local, audio_path, model, txt_path)
+    else:
+        transcription = transcribe_remote(audio_path, model, txt_path, on_chunk=on_chunk)
+
+    try:
+        transcription, gemini_ready = await asyncio.gather(transcription, gemini_access)
+    except Exception:
+        for task in map_tasks.values():
+            task.cancel()
+        raise
+
+    summary_json = None
+    if gemini_ready:
+        print(f"Sending full transcription of {base_name} to Gemini...")
+        partial_tasks = [map_tasks[index] for index in sorted(map_tasks)]
+        summary_json = await generate_gemini_summary(transcription, gemini_model, partial_tasks)
+
+    if summary_json is not None:
+        summary_md = render_obsidian_summary(summary_json, meta)
+    else:
+        print("Gemini summary unavailable, writing a basic summary instead")
+        basic_meta = {**meta, "model": "ninguno (resumen básico)"}
+        summary_md = render_obsidian_summary(generate_basic_summary(transcription.text), basic_meta)
+
+    summary_path = os.path.join(output_dir, f"{base_name}_resumen.md")
+    await asyncio.to_thread(Path(summary_path).write_text, summary_md, encoding="utf-8")
+    print(f"Summary saved to: {summary_path}")
+
+
+async def process_batch(audio_paths, model, output_dir, local=False):
+    os.makedirs(output_dir, exist_ok=True)
+    gemini_access = asyncio.ensure_future(check_gemini_access())
+    gemini_model = get_gemini_model(GEMINI_MODEL)
+
+    # Local transcription already saturates the CPU and shares one Whisper model, so files go one at a time
+    file_semaphore = asyncio.Semaphore(1 if local else FILE_CONCURRENCY)
+
+    async def process_file(path):
+        async with file_semaphore:
+            await aprocess_voice_note_gemini(path, model, output_dir, gemini_access, gemini_model, local=local)
+
+    try:
+        results = await asyncio.gather(*[process_file(path) for path in audio_paths], return_exceptions=True)
+    finally:
+        await _close_session()
+
+    failures = 0
+    for path, result in zip(audio_paths, results):
+        if isinstance(result, Exception):
+            print(f"Error procesando {path}: {result}")
+            failures += 1
+    return failures
+
+
 def main():
     parser = argparse.ArgumentParser(description="Transcribe audio using Hugging Face Whisper and summarize with Gemini.")
-    parser.add_argument("audio_path", help="Path to audio file")
+    parser.add_argument("audio_path", nargs="?", help="Path to audio file")
+    parser.add_argument("--input-dir", help="Process every audio file in this directory")
     parser.add_argument("--model", default="small", choices=WHISPER_MODELS.keys(), help="Whisper model to use")
     parser.add_argument("--output-dir", default="./output", help="Directory to save output files")
+    parser.add_argument("--local", action="store_true", help="Transcribe locally with faster-whisper instead of the Hugging Face API")
     args = parser.parse_args()
 
-    base_name = os.path.splitext(os.path.basename(args.audio_path))[0]
-    chunk_dir = "./chunks"
-    chunk_paths = fragment_audio(args.audio_path, chunk_dir)
-
-    print(f"Audio split into {len(chunk_paths)} chunk(s)")
-    print(f"Sending chunks to Hugging Face API using model: {args.model}")
-
-    transcriptions = asyncio.run(transcribe_all_chunks(chunk_paths, args.model))
-    full_text = "\n\n".join(transcriptions)
-    txt_path = save_transcription(full_text, args.output_dir, base_name)
-
-    print("Sending full transcription to Gemini...")
-    summary_json = generate_gemini_summary(full_text)
-    summary_path = os.path.join(args.output_dir, f"{base_name}_resumen.md")
-    create_obsidian_summary_only(summary_json, base_name, summary_path)
+    if args.input_dir and args.audio_path:
+        parser.error("use either audio_path or --input-dir, not both")
+
+    if args.input_dir:
+        if not os.path.isdir(args.input_dir):
+            parser.error(f"--input-dir {args.input_dir} is not a directory")
+        audio_paths = sorted(
+            str(path) for path in Path(args.input_dir).glob("*")
+            if path.suffix.lower() in AUDIO_EXTENSIONS
+        )
+        if not audio_paths:
+            parser.error(f"no audio files found in {args.input_dir}")
+    elif args.audio_path:
+        audio_paths = [args.audio_path]
+    else:
+        parser.error("audio_path or --input-dir is required")
+
+    # Outputs are named after the file stem, so two inputs sharing one would overwrite each other
+    stems = [Path(path).stem for path in audio_paths]
+    duplicates = sorted({stem for stem in stems if stems.count(stem) > 1})
+    if duplicates:
+        parser.error(f"several input files share the name {', '.join(duplicates)}; rename them so their outputs do not collide")
+
+    if not args.local and HF_API_TOKEN is None:
+        raise EnvironmentError("HF_API_TOKEN not found in environment variables.")
+
+    print(f"Processing {len(audio_paths)} audio file(s)")
+    failures = asyncio.run(process_batch(audio_paths, args.model, args.output_dir, local=args.local))
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":